@@ -74,6 +74,10 @@ POOL = Pool()
 logging.getLogger('quart.app').removeHandler(default_handler)
 logging.getLogger('quart.app').removeHandler(serving_handler)
 
+@APP.after_serving
+async def close_pool():
+	await POOL.close()
+
 @APP.route("/", methods=["GET"])
 async def landing():
 	"""Handles requests to the defined return URI."""
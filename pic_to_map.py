@@ -10,14 +10,15 @@ if __name__ == "__main__":
 		img = Image.open(sys.argv[1])
 
 		array = np.array(img)
+		colors = RedditColor.closest_batch(array)
+		if array.shape[-1] > 3:
+			colors[array[..., 3] != 255] = -1
 
 		with open(new_fname, "w") as f:
 			for x in range(array.shape[0]):
 				for y in range(array.shape[1]):
-					clr = array[x][y]
-					if len(clr) > 3 and clr[3] != 255:
+					if colors[x][y] == -1:
 						f.write("-1 ")
 						continue
-					color = RedditColor.closest(clr[0], clr[1], clr[2])
-					f.write(f"{color.value:02d} ")
+					f.write(f"{colors[x][y]:02d} ")
 				f.write("\n")
\ No newline at end of file
@@ -1,41 +1,44 @@
 import math
+import numpy as np
 
 from enum import Enum
-from typing import Dict, Tuple
-
-_color_map : Dict[int, Tuple[int, int, int]] = {
-	1:  (190, 0, 57),
-	2:  (255, 69, 0),
-	3:  (255, 168, 0),
-	4:  (255, 214, 53),
-	5:  (255, 248, 184),
-	6:  (0, 163, 104),
-	7:  (0, 204, 120),
-	8:  (126, 237, 86),
-	9:  (0, 117, 111),
-	10: (0, 158, 170),
-	11: (0, 204, 192),
-	12: (36, 80, 164),
-	13: (54, 144, 234),
-	14: (81, 233, 244),
-	15: (73, 58, 193),
-	16: (106, 92, 255),
-	17: (148, 179, 255),
-	18: (129, 30, 159),
-	19: (180, 74, 192),
-	20: (228, 171, 255),
-	21: (222, 16, 127),
-	22: (255, 56, 129),
-	23: (255, 153, 170),
-	24: (109, 72, 47),
-	25: (156, 105, 38),
-	26: (255, 180, 112),
-	27: (0, 0, 0),
-	28: (81, 82, 82),
-	29: (137, 141, 144),
-	30: (212, 215, 217),
-	31: (255, 255, 255)
-}
+from typing import List, Optional, Tuple
+
+# reddit number and rgb value of every palette color, as parallel arrays
+_PALETTE_RGB : np.ndarray = np.array([
+	(190, 0, 57),     # 1
+	(255, 69, 0),     # 2
+	(255, 168, 0),    # 3
+	(255, 214, 53),   # 4
+	(255, 248, 184),  # 5
+	(0, 163, 104),    # 6
+	(0, 204, 120),    # 7
+	(126, 237, 86),   # 8
+	(0, 117, 111),    # 9
+	(0, 158, 170),    # 10
+	(0, 204, 192),    # 11
+	(36, 80, 164),    # 12
+	(54, 144, 234),   # 13
+	(81, 233, 244),   # 14
+	(73, 58, 193),    # 15
+	(106, 92, 255),   # 16
+	(148, 179, 255),  # 17
+	(129, 30, 159),   # 18
+	(180, 74, 192),   # 19
+	(228, 171, 255),  # 20
+	(222, 16, 127),   # 21
+	(255, 56, 129),   # 22
+	(255, 153, 170),  # 23
+	(109, 72, 47),    # 24
+	(156, 105, 38),   # 25
+	(255, 180, 112),  # 26
+	(0, 0, 0),        # 27
+	(81, 82, 82),     # 28
+	(137, 141, 144),  # 29
+	(212, 215, 217),  # 30
+	(255, 255, 255),  # 31
+], dtype=np.uint8)
+_PALETTE_IDX : np.ndarray = np.arange(1, len(_PALETTE_RGB) + 1, dtype=np.int32)
 
 _FLT = 0xFF
 
@@ -52,6 +55,26 @@ def pack(r:int, g:int, b:int) -> int:
 		((_FLT & b) << 16)
 	)
 
+def unpack_batch(colors:np.ndarray) -> np.ndarray:
+	"""Vectorized unpack, turns an array of packed colors into a (..., 3) uint8 rgb array"""
+	colors = np.asarray(colors)
+	return np.stack([colors & _FLT, (colors >> 8) & _FLT, (colors >> 16) & _FLT], axis=-1).astype(np.uint8)
+
+def pack_batch(rgb:np.ndarray) -> np.ndarray:
+	"""Vectorized pack, turns a (..., 3) or (..., 4) rgb(a) array into uint32 packed colors, alpha is dropped
+	and channels outside 0-255 are clamped"""
+	rgb = np.asarray(rgb)
+	if rgb.dtype == np.uint8 and rgb.shape[-1] == 4 and rgb.flags.c_contiguous and np.little_endian:
+		# rgba bytes already are the packed layout, just reinterpret them and mask out alpha
+		return rgb.view(np.uint32)[..., 0] & 0xFFFFFF
+	if rgb.dtype != np.uint8:
+		rgb = np.clip(rgb[..., :3], 0, 255) # masking would wrap out of range channels around
+	return (
+		rgb[..., 0].astype(np.uint32) |
+		(rgb[..., 1].astype(np.uint32) << 8) |
+		(rgb[..., 2].astype(np.uint32) << 16)
+	)
+
 class RedditColor(Enum):
 	DARK_RED = 1            #BE0039
 	RED = 2                 #FF4500
@@ -87,15 +110,14 @@ class RedditColor(Enum):
 
 	@classmethod
 	def closest(cls, r, g, b):
-		closest_color = None
-		color_distance = None
-		for color in cls:
-			cr, cg, cb = color.to_tuple()
-			color_diff = math.sqrt((r - cr) ** 2 + (g - cg) ** 2 + (b - cb) ** 2)
-			if color_distance is None or color_diff < color_distance:
-				color_distance = color_diff
-				closest_color = color
-		return closest_color
+		# clamp, packing would otherwise wrap out of range channels around
+		r, g, b = (min(max(int(v), 0), 255) for v in (r, g, b))
+		return _PALETTE_MEMBERS[_closest_packed(pack(r, g, b))]
+
+	@classmethod
+	def closest_batch(cls, pixels:np.ndarray) -> np.ndarray:
+		"""Maps an (..., 3) or (..., 4) array of rgb(a) pixels to the reddit numbers of their closest colors"""
+		return _PALETTE_IDX[_closest_packed_batch(pack_batch(pixels))]
 	
 	@classmethod
 	def closest_color(
@@ -104,13 +126,90 @@ class RedditColor(Enum):
 		"""Find the closest rgb color from palette to a target rgb color, as well as handling transparency"""
 
 		r, g, b = target_rgb[:3]
-		color_diffs = []
+		best = math.inf
+		best_color = None
 		for color in rgb_colors_array:
 			cr, cg, cb = color
-			color_diff = math.sqrt((r - cr) ** 2 + (g - cg) ** 2 + (b - cb) ** 2)
-			color_diffs.append((color_diff, color))
-		return min(color_diffs)[1]
+			# squared distance, same ordering as with sqrt. stop summing once it can't win
+			d = (r - cr) * (r - cr)
+			if d > best:
+				continue
+			d += (g - cg) * (g - cg)
+			if d > best:
+				continue
+			d += (b - cb) * (b - cb)
+			if d < best or (d == best and color < best_color): # ties go to the smaller color, as min() did
+				best = d
+				best_color = color
+		return best_color
+
+	def to_tuple(self) -> Tuple[int, int, int]:
+		return self._rgb
+
+_PALETTE_MEMBERS : List[RedditColor] = [ RedditColor(int(idx)) for idx in _PALETTE_IDX ]
+for _m, _rgb in zip(_PALETTE_MEMBERS, _PALETTE_RGB.tolist()):
+	_m._rgb = tuple(_rgb) # plain field, so to_tuple() needs no lookup
+del _m, _rgb
+
+# colors are matched in CIELAB, where euclidean distance tracks perceived difference
+_SRGB_TO_LINEAR : np.ndarray = np.where( # indexed by 8-bit channel value
+	np.arange(256) / 255 > 0.04045,
+	((np.arange(256) / 255 + 0.055) / 1.055) ** 2.4,
+	np.arange(256) / 255 / 12.92,
+)
+_LINEAR_TO_XYZ : np.ndarray = np.array([ # sRGB primaries, normalized to the D65 white point
+	[0.4124564, 0.3575761, 0.1804375],
+	[0.2126729, 0.7151522, 0.0721750],
+	[0.0193339, 0.1191920, 0.9503041],
+]) / np.array([[0.95047], [1.0], [1.08883]])
+
+def _to_lab(pixels:np.ndarray) -> np.ndarray:
+	"""Converts an (N, 3) array of 8-bit rgb pixels to CIELAB"""
+	xyz = _SRGB_TO_LINEAR[pixels] @ _LINEAR_TO_XYZ.T
+	f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+	return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=-1)
+
+_PALETTE_LAB : np.ndarray = _to_lab(_PALETTE_RGB)
+_PALETTE_LAB_T : np.ndarray = np.ascontiguousarray(_PALETTE_LAB.T)
+_PALETTE_HALF_SQNORM : np.ndarray = 0.5 * (_PALETTE_LAB ** 2).sum(1)
+
+_CHUNK = 4096 # rows scored at once, keeps the (chunk x palette) score matrix in cache
+
+# palette index of every packed 24-bit color, filled in lazily as colors are looked up
+_UNSET = 0xFF
+_LUT : Optional[np.ndarray] = None
+
+def _lut() -> np.ndarray:
+	global _LUT
+	if _LUT is None:
+		_LUT = np.full(1 << 24, _UNSET, dtype=np.uint8) # 16MB, only allocated once needed
+	return _LUT
+
+def _closest_packed(color:int) -> int:
+	"""Returns the palette index closest to a packed rgb color"""
+	lut = _lut()
+	row = lut[color]
+	if row == _UNSET:
+		row = lut[color] = _closest_rows(np.array([unpack(color)]))[0]
+	return int(row)
 
-	def to_tuple(self):
-		return _color_map[self.value]
+def _closest_packed_batch(colors:np.ndarray) -> np.ndarray:
+	"""Returns the palette index closest to each packed rgb color of an array"""
+	lut = _lut()
+	rows = lut[colors]
+	missing = rows == _UNSET
+	if missing.any():
+		new = np.unique(colors[missing])
+		lut[new] = _closest_rows(unpack_batch(new))
+		rows = lut[colors]
+	return rows
 
+def _closest_rows(pixels:np.ndarray) -> np.ndarray:
+	"""Returns the palette index closest to each row of an (N, 3) rgb array"""
+	out = np.empty(len(pixels), dtype=np.intp)
+	for i in range(0, len(pixels), _CHUNK):
+		q = _to_lab(pixels[i:i + _CHUNK])
+		# |q-x|^2 / 2 = |x|^2 / 2 - <q,x> + const, so no sqrt and no per-call subtraction
+		scores = _PALETTE_HALF_SQNORM - q @ _PALETTE_LAB_T
+		scores.argmin(axis=1, out=out[i:i + _CHUNK])
+	return out
@@ -1,8 +1,11 @@
 import os
+import asyncio
 import aiohttp
 import json
+import orjson
+import numpy as np
 from time import time
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 import logging
 from uuid import uuid4
 
@@ -10,8 +13,22 @@ from aioconsole import ainput
 from place.colors import RedditColor
 from ..controller import CLIENT_ID, CLIENT_SECRET, USER_AGENT
 
-def get_payload(x:int, y:int, c:int):
-	return """{"operationName":"setPixel","variables":{"input":{"actionName":"r/replace:set_pixel","PixelMessageData":{"coordinate":{"x":%d,"y":%d},"colorIndex":%d,"canvasIndex":%d}}},"query":"mutation setPixel($input: ActInput!) {\\n act(input: $input) {\\n data {\\n ... on BasicMessage {\\n id\\n data {\\n ... on GetUserCooldownResponseMessageData {\\n nextAvailablePixelTimestamp\\n __typename\\n }\\n ... on SetPixelResponseMessageData {\\n timestamp\\n __typename\\n }\\n __typename\\n }\\n __typename\\n }\\n __typename\\n }\\n __typename\\n }\\n}\\n"}""" % (x, y, c, 0)
+_PAYLOAD_TMPL : bytes = b"""{"operationName":"setPixel","variables":{"input":{"actionName":"r/replace:set_pixel","PixelMessageData":{"coordinate":{"x":%d,"y":%d},"colorIndex":%d,"canvasIndex":0}}},"query":"mutation setPixel($input: ActInput!) {\\n act(input: $input) {\\n data {\\n ... on BasicMessage {\\n id\\n data {\\n ... on GetUserCooldownResponseMessageData {\\n nextAvailablePixelTimestamp\\n __typename\\n }\\n ... on SetPixelResponseMessageData {\\n timestamp\\n __typename\\n }\\n __typename\\n }\\n __typename\\n }\\n __typename\\n }\\n __typename\\n }\\n}\\n"}"""
+
+def get_payload(x:int, y:int, c:int) -> bytes:
+	return _PAYLOAD_TMPL % (x, y, c) # canvas index is always 0, it's baked in the template
+
+_SESSION : Optional[aiohttp.ClientSession] = None
+
+def get_session() -> aiohttp.ClientSession:
+	"""Returns the ClientSession shared by all users, so connections to reddit are pooled"""
+	global _SESSION
+	if _SESSION is None or _SESSION.closed: # created lazily, it needs a running event loop
+		_SESSION = aiohttp.ClientSession(
+			cookie_jar=aiohttp.DummyCookieJar(), # never share cookies between accounts
+			connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300),
+		)
+	return _SESSION
 
 class UnauthorizedError(Exception):
 	refreshable : bool
@@ -24,7 +41,8 @@ class User:
 	name : str
 	token : str
 	refresh : Optional[str]
-	next : Optional[int]
+	pool : Optional['Pool']
+	slot : int # position in pool.users
 
 	URL = "https://gql-realtime-2.reddit.com/query"
 
@@ -41,6 +59,8 @@ class User:
 		self.name = name
 		self.token = token
 		self.refresh = refresh
+		self.pool = None
+		self.slot = 0
 		self.next = next
 
 	def as_dict(self):
@@ -56,12 +76,11 @@ class User:
 		return json.dumps(self.as_dict())
 
 	async def get_username(self):
-		async with aiohttp.ClientSession() as sess:
-			async with sess.get(
-				"https://oauth.reddit.com/api/v1/me",
-				headers={"User-Agent": USER_AGENT, "Authorization": f"bearer {self.token}"},
-			) as res:
-				data = await res.json()
+		async with get_session().get(
+			"https://oauth.reddit.com/api/v1/me",
+			headers={"User-Agent": USER_AGENT, "Authorization": f"bearer {self.token}"},
+		) as res:
+			data = orjson.loads(await res.read())
 		self.name = data['subreddit']['display_name_prefixed']
 		return self.name
 
@@ -73,16 +92,15 @@ class User:
 			'grant_type': 'refresh_token',
 			'refresh_token': self.refresh
 		}
-		async with aiohttp.ClientSession() as sess:
-			async with sess.post(
-				"https://www.reddit.com/api/v1/access_token",
-				data=gayson,
-				headers={'User-Agent': USER_AGENT},
-				auth=aiohttp.BasicAuth(login=CLIENT_ID, password=CLIENT_SECRET),
-			) as res:
-				data = await res.json()
-				self.logger.debug(data)
-				self.token = data['access_token']
+		async with get_session().post(
+			"https://www.reddit.com/api/v1/access_token",
+			data=gayson,
+			headers={'User-Agent': USER_AGENT},
+			auth=aiohttp.BasicAuth(login=CLIENT_ID, password=CLIENT_SECRET),
+		) as res:
+			data = orjson.loads(await res.read())
+			self.logger.debug(data)
+			self.token = data['access_token']
 		await self.get_username() # make sure new token is valid
 		self.logger.info(f"refreshed user {self.name}")
 		
@@ -100,44 +118,51 @@ class User:
 		}
 
 	
+	@property
+	def next(self) -> Optional[float]:
+		return self._next
+
+	@next.setter
+	def next(self, value:Optional[float]):
+		self._next = value
+		if self.pool is not None:
+			self.pool._next[self.slot] = value or 0 # keep the pool's cooldowns in sync
+
 	@property
 	def cooldown(self):
 		return (self.next or 0) - time()
 
 	async def put(self, color:int, x:int, y:int) -> bool:
 		self.logger.info("putting [%s] at %d|%d", RedditColor(color), x, y)
-		async with aiohttp.ClientSession() as sess:
-			async with sess.post(self.URL, headers=self.headers, data=get_payload(x=x, y=y, c=color)) as res:
-				answ = await res.json()
-				self.logger.debug("set-pixel response: %s", str(answ))
-		if 'success' in answ and not answ['success'] \
-		and 'error' in answ and answ['error'] \
-		and 'reason' in answ['error'] and answ['error']['reason'] == 'UNAUTHORIZED':
+		async with get_session().post(self.URL, headers=self.headers, data=get_payload(x=x, y=y, c=color)) as res:
+			answ = orjson.loads(await res.read())
+			self.logger.debug("set-pixel response: %s", answ)
+		if not answ.get('success', True) and (answ.get('error') or {}).get('reason') == 'UNAUTHORIZED':
 			raise UnauthorizedError(str(answ))
-		if "data" in answ and answ['data']:
-			for act in answ["data"]["act"]["data"]:
-				if "nextAvailablePixelTimestamp" in act['data']:
-					self.next = act['data']['nextAvailablePixelTimestamp'] / 1000
-					if self.next and self.next - time() > 60 * 60 * 24 * 31:
-						raise UnauthorizedError("Rate limited: cooldown too long", refreshable=False)
-					return True
-		if "errors" in answ and answ['errors']:
-			for err in answ['errors']:
-				if 'extensions' in err:
-					if 'nextAvailablePixelTs' in err['extensions']:
-						self.next = err['extensions']['nextAvailablePixelTs'] / 1000
-						if self.next and self.next - time() > 60 * 60 * 24 * 31:
-							raise UnauthorizedError("Rate limited: cooldown too long", refreshable=False)
-						return False
+		for act in ((answ.get('data') or {}).get('act') or {}).get('data') or ():
+			ts = (act.get('data') or {}).get('nextAvailablePixelTimestamp')
+			if ts is not None:
+				self.next = ts / 1000
+				if self.next and self.next - time() > 60 * 60 * 24 * 31:
+					raise UnauthorizedError("Rate limited: cooldown too long", refreshable=False)
+				return True
+		for err in answ.get('errors') or ():
+			ts = (err.get('extensions') or {}).get('nextAvailablePixelTs')
+			if ts is not None:
+				self.next = ts / 1000
+				if self.next and self.next - time() > 60 * 60 * 24 * 31:
+					raise UnauthorizedError("Rate limited: cooldown too long", refreshable=False)
+				return False
 
 class Pool:
 	users : List[User]
+	_next : np.ndarray # next of every user, parallel to users
 
 	def __init__(self, storage="pool.json"):
 		self.users = list()
 		if os.path.isfile(storage):
-			with open(storage) as f:
-				data = json.load(f)
+			with open(storage, "rb") as f:
+				data = orjson.loads(f.read())
 			for el in data:
 				self.users.append(
 					User(
@@ -148,6 +173,7 @@ class Pool:
 						id=el["id"] if "id" in el else None,
 					)
 				)
+		self._reindex()
 
 	def __iter__(self):
 		return iter(self.users)
@@ -155,40 +181,69 @@ class Pool:
 	def __len__(self):
 		return len(self.users)
 
+	async def close(self):
+		"""Closes the shared ClientSession used by the users"""
+		if _SESSION is not None and not _SESSION.closed:
+			await _SESSION.close()
+
 	def serialize(self, storage="pool.json"):
-		with open(storage, "w") as f:
-			json.dump([ u.as_dict() for u in self.users ], f, default=str, indent=2)
+		data = orjson.dumps([ u.as_dict() for u in self.users ], default=str, option=orjson.OPT_INDENT_2)
+		tmp = storage + ".tmp"
+		with open(tmp, "wb") as f:
+			f.write(data)
+		os.replace(tmp, storage) # atomic, a crash mid-write can't corrupt the pool
+
+	def _reindex(self):
+		"""Rebuilds the cooldown array after users were loaded or removed"""
+		for i, u in enumerate(self.users):
+			u.pool = self
+			u.slot = i
+		self._next = np.array([ u.next or 0 for u in self.users ], dtype=np.float64)
 
 	@property
 	def any(self) -> bool:
-		return any(u.cooldown <= 0 for u in self)
+		return bool((self._next <= time()).any())
+
+	def _ready(self) -> List[User]:
+		return [ self.users[i] for i in np.flatnonzero(self._next <= time()) ]
 
 	@property
 	def ready(self) -> int:
 		"""Returns how many users are ready to place"""
-		return sum(1 for u in self.users if u.cooldown <= 0)
+		return int((self._next <= time()).sum())
 
 	def best(self) -> User:
 		"""Returns the user with the shortest cooldown"""
-		cd = None
-		usr = None
-		for u in self:
-			if cd is None or u.cooldown < cd:
-				cd = u.cooldown
-				usr = u
-		return usr
+		if not self.users:
+			return None
+		return self.users[int(self._next.argmin())]
 
 	def add_user(self, u:User):
+		u.pool = self
+		u.slot = len(self.users)
 		self.users.append(u)
+		self._next = np.append(self._next, u.next or 0)
 		self.serialize()
 
 	def remove_user(self, n:str):
+		for u in self.users:
+			if u.name == n:
+				u.pool = None
 		self.users = [u for u in self.users if u.name != n]
+		self._reindex()
 		self.serialize()
 		
 	async def put(self, color:RedditColor, x:int, y:int):
-		for u in self.users:
-			if u.cooldown <= 0:
-				await u.put(color, x, y)
-				return True
-		return False
\ No newline at end of file
+		ready = self._next <= time()
+		if ready.any():
+			await self.users[int(ready.argmax())].put(color, x, y)
+			return True
+		return False
+
+	async def put_batch(self, pixels:List[Tuple[RedditColor, int, int]]) -> List[Union[Optional[bool], BaseException]]:
+		"""Places pixels concurrently, one per ready user, returns what each put returned or raised"""
+		users = self._ready() # only the first min(ready, len(pixels)) pixels are attempted
+		return await asyncio.gather(
+			*(u.put(c, x, y) for u, (c, x, y) in zip(users, pixels)),
+			return_exceptions=True,
+		)